@@ -1,12 +1,18 @@
 """
 description: A pipeline for generating text using the DeepSeek R1 model via Azure AI Inference API, with fixed stream handling.
-requirements: azure-ai-inference
+requirements: azure-ai-inference, orjson, requests
 environment_variables: AZURE_INFERENCE_CREDENTIAL, AZURE_INFERENCE_ENDPOINT, MODEL_ID
 """
 
+import functools
 import os
-import json
 import logging
+import queue
+import socket
+import threading
+
+import orjson
+import requests
 from typing import List, Union, Generator, Iterator, Tuple
 from pydantic import BaseModel
 from azure.ai.inference import ChatCompletionsClient
@@ -14,10 +20,47 @@ from azure.core.credentials import AzureKeyCredential
 from azure.ai.inference.models import SystemMessage, UserMessage, AssistantMessage
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@functools.cache
+def _env(key: str, default: str) -> str:
+    """Read an environment variable once per process and cache it."""
+    return os.getenv(key, default)
+
+
+# Request parameters forwarded to Azure; built once so pipe() can filter
+# the body with a C-level key intersection instead of a fresh set literal.
+_ALLOWED_PARAMS = frozenset({
+    'temperature', 'max_tokens', 'presence_penalty', 'frequency_penalty',
+    'top_p'
+})
+
+# Bounded buffer between the Azure stream reader and the consumer; big
+# enough to absorb consumer hiccups without unbounded memory growth.
+_STREAM_QUEUE_MAXSIZE = 32
+_STREAM_END = object()
+
+
+class _NoDelayAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that disables Nagle's algorithm on pooled sockets.
+
+    Small SSE chunks otherwise coalesce with the delayed-ACK timer,
+    adding up to ~200ms between tokens on the wire.
+    """
+
+    _SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self._SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
 def pop_system_message(messages: List[dict]) -> Tuple[str, List[dict]]:
     """
     Extract the system message from the list of messages.
@@ -28,23 +71,62 @@ def pop_system_message(messages: List[dict]) -> Tuple[str, List[dict]]:
     Returns:
     Tuple[str, List[dict]]: A tuple containing the system message (or empty string) and the updated list of messages.
     """
-    system_message = ""
-    updated_messages = []
+    sys_idx = next(
+        (i for i, message in enumerate(messages)
+         if message['role'] == 'system'), -1)
+
+    if sys_idx < 0:
+        # Common case: no system message, so no list copy needed.
+        return "", messages
+
+    return messages[sys_idx]['content'], [
+        message for message in messages if message['role'] != 'system'
+    ]
+
 
-    for message in messages:
-        if message['role'] == 'system':
-            system_message = message['content']
-        else:
-            updated_messages.append(message)
+def _fast_stream(response: requests.Response) -> Iterator[str]:
+    """
+    Parse a chat-completions SSE stream straight from the raw bytes.
 
-    return system_message, updated_messages
+    Splits records on the blank-line boundary with C-level bytearray
+    operations and decodes each payload with orjson, yielding only the
+    delta text — no per-token SDK model hydration.
+    """
+    buf = bytearray()
+    for chunk in response.iter_content(chunk_size=None):
+        buf.extend(chunk)
+        while (end := buf.find(b"\n\n")) >= 0:
+            record = bytes(buf[:end])
+            del buf[:end + 2]
+            for line in record.split(b"\n"):
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip(b" \r")
+                if payload == b"[DONE]":
+                    return
+                choices = orjson.loads(payload).get("choices")
+                if choices:
+                    delta_content = choices[0].get("delta", {}).get("content")
+                    if delta_content:
+                        yield delta_content
 
 
 class Pipeline:
 
+    # Maps a message role to its Azure message class with one dict lookup
+    # instead of chained comparisons per message.
+    _ROLE_MAP = {
+        'user': UserMessage,
+        'assistant': AssistantMessage,
+        'system': SystemMessage,
+    }
+
     class Valves(BaseModel):
         AZURE_INFERENCE_CREDENTIAL: str = ""
         AZURE_INFERENCE_ENDPOINT: str = ""
+        # Mirrors the ChatCompletionsClient default so the raw streaming
+        # path hits the same API surface as the SDK path.
+        AZURE_INFERENCE_API_VERSION: str = "2024-05-01-preview"
         MODEL_ID: str = "DeepSeekR1"
 
     def __init__(self):
@@ -55,21 +137,48 @@ class Pipeline:
         self.valves = self.Valves(
             **{
                 "AZURE_INFERENCE_CREDENTIAL":
-                os.getenv("AZURE_INFERENCE_CREDENTIAL",
-                          "your-azure-inference-key-here"),
+                _env("AZURE_INFERENCE_CREDENTIAL",
+                     "your-azure-inference-key-here"),
                 "AZURE_INFERENCE_ENDPOINT":
-                os.getenv("AZURE_INFERENCE_ENDPOINT",
-                          "your-azure-inference-endpoint-here"),
+                _env("AZURE_INFERENCE_ENDPOINT",
+                     "your-azure-inference-endpoint-here"),
+                "AZURE_INFERENCE_API_VERSION":
+                _env("AZURE_INFERENCE_API_VERSION", "2024-05-01-preview"),
                 "MODEL_ID":
-                os.getenv("MODEL_ID", "DeepSeekR1"),
+                _env("MODEL_ID", "DeepSeekR1"),
             })
-        self.update_client()
-
-    def update_client(self):
-        self.client = ChatCompletionsClient(
-            endpoint=self.valves.AZURE_INFERENCE_ENDPOINT,
-            credential=AzureKeyCredential(
-                self.valves.AZURE_INFERENCE_CREDENTIAL))
+        # Client construction is deferred to first use so pipeline
+        # discovery does not pay SDK setup for pipelines that are never
+        # called.
+        self._client = None
+        self._client_config = None
+        self._credential = None
+        self._stream_session = None
+
+    @property
+    def client(self) -> ChatCompletionsClient:
+        if self._client is None:
+            credential_key = self.valves.AZURE_INFERENCE_CREDENTIAL
+            if self._credential is None or self._credential.key != credential_key:
+                self._credential = AzureKeyCredential(credential_key)
+            self._client = ChatCompletionsClient(
+                endpoint=self.valves.AZURE_INFERENCE_ENDPOINT,
+                credential=self._credential)
+            self._client_config = (self.valves.AZURE_INFERENCE_ENDPOINT,
+                                   credential_key)
+        return self._client
+
+    def _get_stream_session(self) -> requests.Session:
+        # Pooled session for the raw streaming path; lazy like the SDK
+        # client, with Nagle disabled so each token hits the wire
+        # immediately.
+        if self._stream_session is None:
+            session = requests.Session()
+            adapter = _NoDelayAdapter()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._stream_session = session
+        return self._stream_session
 
     def get_DeepSeekR1_models(self):
         return [
@@ -88,7 +197,13 @@ class Pipeline:
         pass
 
     async def on_valves_updated(self):
-        self.update_client()
+        # Drop the cached client only when the endpoint or credential
+        # actually changed; its pooled connections survive updates to
+        # unrelated valves such as MODEL_ID.
+        config = (self.valves.AZURE_INFERENCE_ENDPOINT,
+                  self.valves.AZURE_INFERENCE_CREDENTIAL)
+        if config != self._client_config:
+            self._client = None
 
     def pipelines(self) -> List[dict]:
         return self.get_DeepSeekR1_models()
@@ -96,11 +211,14 @@ class Pipeline:
     def pipe(self, user_message: str, model_id: str, messages: List[dict],
              body: dict) -> Union[str, Generator, Iterator]:
         try:
-            logger.debug(
-                f"Received request - user_message: {user_message}, model_id: {model_id}"
-            )
-            logger.debug(f"Messages: {json.dumps(messages, indent=2)}")
-            logger.debug(f"Body: {json.dumps(body, indent=2)}")
+            # Lazy %s formatting: the messages/body are only rendered when
+            # DEBUG is actually emitted.
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Received request - user_message: %s, model_id: %s",
+                    user_message, model_id)
+                logger.debug("Messages: %s", messages)
+                logger.debug("Body: %s", body)
 
             # Remove unnecessary keys
             for key in ['user', 'chat_id', 'title']:
@@ -108,70 +226,124 @@ class Pipeline:
 
             system_message, messages = pop_system_message(messages)
 
-            # Prepare messages for DeepSeekR1
-            DeepSeekR1_messages = [SystemMessage(
-                content=system_message)] if system_message else []
-            DeepSeekR1_messages += [
-                UserMessage(content=msg['content']) if msg['role'] == 'user'
-                else SystemMessage(content=msg['content']) if msg['role']
-                == 'system' else AssistantMessage(content=msg['content'])
-                for msg in messages
-            ]
-
             # Prepare the payload
-            allowed_params = {
-                'temperature', 'max_tokens', 'presence_penalty',
-                'frequency_penalty', 'top_p'
-            }
             filtered_body = {
-                k: v
-                for k, v in body.items() if k in allowed_params
+                k: body[k]
+                for k in body.keys() & _ALLOWED_PARAMS
             }
 
-            logger.debug(f"Prepared DeepSeekR1 messages: {DeepSeekR1_messages}")
-            logger.debug(f"Filtered body: {filtered_body}")
+            logger.debug("Filtered body: %s", filtered_body)
 
             is_stream = body.get("stream", False)
             if is_stream:
-                return self.stream_response(DeepSeekR1_messages, filtered_body)
-            else:
-                return self.get_completion(DeepSeekR1_messages, filtered_body)
+                # The streaming path posts plain dict messages straight to
+                # the endpoint, so no SDK message objects are built.
+                stream_messages = ([{
+                    "role": "system",
+                    "content": system_message
+                }] if system_message else []) + messages
+                return self.stream_response(stream_messages, filtered_body)
+
+            # Prepare messages for DeepSeekR1
+            DeepSeekR1_messages = [SystemMessage(
+                content=system_message)] if system_message else []
+            # Bind the dispatch lookup and fallback constructor to locals
+            # so the comprehension does LOAD_FAST instead of attribute and
+            # global lookups per message.
+            to_message, default_message = self._ROLE_MAP.get, UserMessage
+            DeepSeekR1_messages += [
+                to_message(msg['role'], default_message)(content=msg['content'])
+                for msg in messages
+            ]
+            logger.debug("Prepared DeepSeekR1 messages: %s",
+                         DeepSeekR1_messages)
+            return self.get_completion(DeepSeekR1_messages, filtered_body)
         except Exception as e:
             logger.error(f"Error in pipe: {str(e)}", exc_info=True)
-            return json.dumps({"error": str(e)})
+            return orjson.dumps({"error": str(e)}).decode()
+
+    def stream_response(self, messages: List[dict], params: dict) -> Iterator[str]:
+        # A background thread drains the Azure stream into a bounded queue
+        # so a slow consumer does not back-pressure the read loop (and the
+        # read loop does not stall the consumer between chunks). The
+        # stream is read as raw SSE bytes via _fast_stream rather than
+        # through the SDK's per-update model objects.
+        buffer: queue.Queue = queue.Queue(maxsize=_STREAM_QUEUE_MAXSIZE)
+        # Set when the consumer abandons the generator (stop button,
+        # client disconnect) so the producer does not block forever on a
+        # full queue and tears down its HTTP response.
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=1.0)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            response = None
+            try:
+                url = (f"{self.valves.AZURE_INFERENCE_ENDPOINT.rstrip('/')}"
+                       "/chat/completions"
+                       f"?api-version={self.valves.AZURE_INFERENCE_API_VERSION}")
+                headers = {
+                    "Authorization":
+                    f"Bearer {self.valves.AZURE_INFERENCE_CREDENTIAL}",
+                    "api-key": self.valves.AZURE_INFERENCE_CREDENTIAL,
+                    "Content-Type": "application/json",
+                    "Accept": "text/event-stream",
+                }
+                payload = {
+                    "messages": messages,
+                    "model": self.valves.MODEL_ID,
+                    "stream": True,
+                    **params,
+                }
+                response = self._get_stream_session().post(url,
+                                                           json=payload,
+                                                           headers=headers,
+                                                           stream=True)
+                response.raise_for_status()
+                for delta_content in _fast_stream(response):
+                    # orjson emits UTF-8 directly, so no ensure_ascii
+                    # escaping pass is needed.
+                    if not put(orjson.dumps({"delta": delta_content}).decode()):
+                        break
+            except Exception as e:
+                logger.error(f"Error in stream_response: {str(e)}",
+                             exc_info=True)
+                put(orjson.dumps({"error": str(e)}).decode())
+            finally:
+                if response is not None:
+                    response.close()
+                put(_STREAM_END)
+
+        threading.Thread(target=produce, daemon=True).start()
 
-    def stream_response(self, DeepSeekR1_messages: List[Union[SystemMessage, UserMessage, AssistantMessage]], params: dict) -> str:
         try:
-            complete_response = ""
-            response = self.client.complete(messages=DeepSeekR1_messages,
-                                            model=self.valves.MODEL_ID,
-                                            stream=True,
-                                            **params)
-            for update in response:
-                if update.choices:
-                    delta_content = update.choices[0].delta.content
-                    if delta_content:
-                        complete_response += delta_content
-            return complete_response
-        except Exception as e:
-            logger.error(f"Error in stream_response: {str(e)}", exc_info=True)
-            return json.dumps({"error": str(e)})
+            while (item := buffer.get()) is not _STREAM_END:
+                yield item
+        finally:
+            stop.set()
 
     def get_completion(self, DeepSeekR1_messages: List[Union[SystemMessage, UserMessage, AssistantMessage]], params: dict) -> str:
         try:
             response = self.client.complete(messages=DeepSeekR1_messages,
                                             model=self.valves.MODEL_ID,
                                             **params)
-            if response.choices:
-                result = response.choices[0].message.content
-                logger.debug(f"Completion result: {result}")
-                return result
-            else:
-                logger.warning("No choices in completion response")
-                return ""
+            # Grab the first choice once instead of re-indexing choices,
+            # which some SDK versions materialize lazily.
+            choice = next(iter(response.choices or ()), None)
+            if choice is not None:
+                return choice.message.content
+            logger.warning("No choices in completion response")
+            return ""
         except Exception as e:
             logger.error(f"Error in get_completion: {str(e)}", exc_info=True)
-            return json.dumps({"error": str(e)})
+            return orjson.dumps({"error": str(e)}).decode()
 
 
 # TEST CASE TO RUN THE PIPELINE
@@ -197,13 +369,14 @@ if __name__ == "__main__":
 
     # Handle streaming result
     if isinstance(result, str):
-        content = json.dumps({"content": result}, ensure_ascii=False)
+        content = orjson.dumps({"content": result}).decode()
         print(content)
     else:
-        complete_response = ""
+        # join is O(n) over the deltas, unlike repeated str +=.
+        parts = []
         for part in result:
-            content_delta = json.loads(part).get("delta")
+            content_delta = orjson.loads(part).get("delta")
             if content_delta:
-                complete_response += content_delta
+                parts.append(content_delta)
 
-        print(json.dumps({"content": complete_response}, ensure_ascii=False))
+        print(orjson.dumps({"content": "".join(parts)}).decode())